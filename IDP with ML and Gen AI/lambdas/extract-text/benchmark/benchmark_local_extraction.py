@@ -0,0 +1,242 @@
+"""
+Quality/latency comparison of the local text-layer extraction against Textract
+FORMS output and hand-transcribed ground truth.
+
+Compare offline (needs pypdf):
+    python benchmark_local_extraction.py [--pdf path/to/doc.pdf ...] [--runs 20]
+
+By default this runs the scanned sample-auto-insurance-claim-doc.pdf and
+fixtures/sample-auto-insurance-claim-doc.typeset.pdf, a born-digital re-typeset
+of the same form (labels and values as separate runs, as on the printed form).
+Both are scored against fixtures/sample-auto-insurance-claim-doc.expected.json,
+transcribed by hand from the scan; a "<name>.<variant>.pdf" shares the ground
+truth of "<name>.pdf". Textract output is read from recorded/<name>.textract.json,
+or failing that from fixtures/<name>.textract-stand-in.json - hand-built blocks in
+Textract's shape that exercise the parsing and comparison, not Textract's accuracy.
+
+Record Textract output with the same asynchronous StartDocumentAnalysis flow the
+extract-text Lambda uses (needs boto3 and AWS credentials; the PDF is uploaded
+to the given bucket for the duration of the job):
+    python benchmark_local_extraction.py --record --bucket my-bucket [--pdf ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from difflib import SequenceMatcher
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+from parser import parse_textract_blocks  # noqa: E402
+from text_layer import extract_text_layer, is_local_extraction_available  # noqa: E402
+
+FIXTURES_DIR = os.path.join(HERE, 'fixtures')
+RECORDINGS_DIR = os.path.join(HERE, 'recorded')
+DEFAULT_PDFS = [
+    os.path.join(HERE, '..', '..', '..', 'assets', 'test_files', 'sample-auto-insurance-claim-doc.pdf'),
+    os.path.join(FIXTURES_DIR, 'sample-auto-insurance-claim-doc.typeset.pdf'),
+]
+
+
+def document_name(pdf_path):
+    return os.path.splitext(os.path.basename(pdf_path))[0]
+
+
+def recording_path(pdf_path):
+    return os.path.join(RECORDINGS_DIR, f"{document_name(pdf_path)}.textract.json")
+
+
+def stand_in_path(pdf_path):
+    return os.path.join(FIXTURES_DIR, f"{document_name(pdf_path)}.textract-stand-in.json")
+
+
+def expected_path(pdf_path):
+    return os.path.join(FIXTURES_DIR, f"{document_name(pdf_path).split('.')[0]}.expected.json")
+
+
+def load_textract_output(pdf_path):
+    # A real recording wins over the hand-built stand-in
+    for path in (recording_path(pdf_path), stand_in_path(pdf_path)):
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+    return None
+
+
+def record_textract(pdf_path, bucket, prefix, poll_interval=1):
+    import boto3
+
+    s3_client = boto3.client('s3')
+    textract_client = boto3.client('textract')
+    key = f"{prefix}{os.path.basename(pdf_path)}"
+    s3_client.upload_file(pdf_path, bucket, key)
+
+    try:
+        # Same call and feature set as the extract-text Lambda
+        start = time.monotonic()
+        response = textract_client.start_document_analysis(
+            DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': key}},
+            FeatureTypes=["FORMS"],
+        )
+        job_id = response['JobId']
+
+        while True:
+            response = textract_client.get_document_analysis(JobId=job_id)
+            if response['JobStatus'] in ['SUCCEEDED', 'FAILED']:
+                break
+            time.sleep(poll_interval)
+        latency = time.monotonic() - start
+
+        if response['JobStatus'] != 'SUCCEEDED':
+            sys.exit(f"Textract job {job_id} failed for {pdf_path}")
+
+        blocks = response.get('Blocks', [])
+        while response.get('NextToken'):
+            response = textract_client.get_document_analysis(JobId=job_id, NextToken=response['NextToken'])
+            blocks.extend(response.get('Blocks', []))
+    finally:
+        s3_client.delete_object(Bucket=bucket, Key=key)
+
+    output_path = recording_path(pdf_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump({
+            'api': 'StartDocumentAnalysis',
+            'feature_types': ["FORMS"],
+            'poll_interval_seconds': poll_interval,
+            'latency_seconds': latency,
+            'Blocks': blocks
+        }, f, indent=2)
+    print(f"Recorded {len(blocks)} Textract blocks ({latency:.1f}s end to end) to {output_path}")
+
+
+def normalize_label(label):
+    return label.strip().rstrip(':').strip().upper()
+
+
+def normalize_pairs(kvs):
+    pairs = set()
+    for label, values in kvs.items():
+        for value in values:
+            pairs.add((normalize_label(label), ' '.join(value.split()).upper()))
+    return pairs
+
+
+def text_similarity(a, b):
+    return SequenceMatcher(None, a.upper().split(), b.upper().split(), autojunk=False).ratio()
+
+
+def print_quality(title, lines, kvs, reference_lines, reference_kvs):
+    pairs = normalize_pairs(kvs)
+    reference_pairs = normalize_pairs(reference_kvs)
+    matched = pairs & reference_pairs
+
+    print(f"  {title}:")
+    print(f"    Lines / pairs:     {len(lines)} / {len(pairs)} (reference {len(reference_lines)} / {len(reference_pairs)})")
+    print(f"    Text similarity:   {text_similarity(' '.join(lines), ' '.join(reference_lines)):.3f}")
+    if reference_pairs:
+        print(f"    Pair recall:       {len(matched) / len(reference_pairs):.3f}")
+    if pairs:
+        print(f"    Pair precision:    {len(matched) / len(pairs):.3f}")
+    for label, value in sorted(reference_pairs - pairs):
+        print(f"    Missed:            {label}: {value}")
+
+
+def compare(pdf_path, runs, min_confidence):
+    with open(pdf_path, 'rb') as f:
+        pdf_bytes = f.read()
+
+    timings = []
+    for _ in range(runs):
+        start = time.monotonic()
+        extraction = extract_text_layer(pdf_bytes)
+        timings.append(time.monotonic() - start)
+
+    # Same routing as extract_local_text_layers in the Lambda
+    if not extraction['lines'] or extraction['confidence'] < min_confidence:
+        route = 'Textract (no usable text layer)' if not extraction['lines'] else 'Textract (low confidence)'
+    elif not extraction['kvs'] and not extraction['image_only_pages']:
+        route = 'Textract (no form pairs in text layer)'
+    elif extraction['image_only_pages']:
+        route = f"local + Textract for pages {extraction['image_only_pages']}"
+    else:
+        route = 'local'
+
+    print(f"{os.path.basename(pdf_path)}")
+    print(f"  Pages:               {len(extraction['pages'])}")
+    print(f"  Image-only pages:    {extraction['image_only_pages']}")
+    print(f"  Local confidence:    {extraction['confidence']:.3f}")
+    print(f"  Route:               {route}")
+    print(f"  Local latency:       median {statistics.median(timings) * 1000:.1f} ms over {runs} runs")
+
+    expected = None
+    if os.path.exists(expected_path(pdf_path)):
+        with open(expected_path(pdf_path)) as f:
+            expected = json.load(f)
+
+    textract = load_textract_output(pdf_path)
+    if textract:
+        page_lines, textract_kvs = parse_textract_blocks(textract['Blocks'])
+        textract_lines = [line for page in sorted(page_lines) for line in page_lines[page]]
+        if textract.get('stand_in'):
+            textract_name = 'Textract stand-in'
+            print(f"  Textract output:     hand-built stand-in, not a recording (no latency)")
+        else:
+            textract_name = 'Textract'
+            print(f"  Textract latency:    {textract['latency_seconds']:.1f} s "
+                  f"(recorded, {textract.get('api', 'unknown API')})")
+
+    if expected:
+        print_quality('Local text layer vs ground truth', extraction['lines'], extraction['kvs'],
+                      expected['lines'], expected['kvs'])
+        if textract:
+            print_quality(f"{textract_name} vs ground truth", textract_lines, textract_kvs,
+                          expected['lines'], expected['kvs'])
+    if textract:
+        print_quality(f"Local text layer vs {textract_name}", extraction['lines'], extraction['kvs'],
+                      textract_lines, textract_kvs)
+
+    # What the pipeline would actually write for this document. A recording covers
+    # the whole document, so mixed documents are not scored here.
+    if expected and route == 'local':
+        print_quality('Routed output (local) vs ground truth', extraction['lines'], extraction['kvs'],
+                      expected['lines'], expected['kvs'])
+    elif expected and textract and route.startswith('Textract'):
+        print_quality(f"Routed output ({textract_name}) vs ground truth", textract_lines, textract_kvs,
+                      expected['lines'], expected['kvs'])
+
+    if not expected and not textract:
+        print(f"  No ground truth or Textract output - run with --record --bucket to capture it")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pdf', action='append', help='PDF to benchmark (repeatable)')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--min-confidence', type=float,
+                        default=float(os.environ.get('LOCAL_EXTRACTION_MIN_CONFIDENCE', '0.9')))
+    parser.add_argument('--record', action='store_true', help='Run Textract and save its output for later comparison')
+    parser.add_argument('--bucket', help='S3 bucket the PDF is uploaded to while recording')
+    parser.add_argument('--prefix', default='textract-benchmark/')
+    args = parser.parse_args()
+    pdf_paths = args.pdf or DEFAULT_PDFS
+
+    if args.record:
+        if not args.bucket:
+            parser.error('--record requires --bucket')
+        for pdf_path in pdf_paths:
+            record_textract(pdf_path, args.bucket, args.prefix)
+        return
+
+    if not is_local_extraction_available():
+        sys.exit("pypdf is required for local extraction: pip install pypdf")
+    for pdf_path in pdf_paths:
+        compare(pdf_path, args.runs, args.min_confidence)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Build package/DocuStreamExtractTextLambdaFunction.zip from src/ and requirements.txt.
+
+    python build_package.py
+
+Dependencies are installed for the Lambda runtime (Python 3.12, x86_64) with
+pinned hashes, and archive entries are sorted with fixed timestamps and
+permissions, so the same sources always produce the same zip.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(HERE, 'src')
+PACKAGE_PATH = os.path.join(HERE, 'package', 'DocuStreamExtractTextLambdaFunction.zip')
+FIXED_DATE = (1980, 1, 1, 0, 0, 0)
+
+
+def install_requirements(target):
+    subprocess.run([
+        sys.executable, '-m', 'pip', 'install', '--quiet',
+        '--requirement', os.path.join(HERE, 'requirements.txt'), '--require-hashes',
+        '--target', target, '--no-compile', '--no-deps', '--only-binary=:all:',
+        '--platform', 'manylinux2014_x86_64', '--implementation', 'cp', '--python-version', '3.12',
+    ], check=True)
+
+
+def collect_files(root):
+    files = []
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if name != '__pycache__']
+        for name in filenames:
+            if name.endswith('.pyc'):
+                continue
+            path = os.path.join(directory, name)
+            files.append((os.path.relpath(path, root).replace(os.sep, '/'), path))
+    return files
+
+
+def build():
+    with tempfile.TemporaryDirectory() as target:
+        install_requirements(target)
+        files = sorted(collect_files(SRC_DIR) + collect_files(target))
+
+        with zipfile.ZipFile(PACKAGE_PATH, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, path in files:
+                info = zipfile.ZipInfo(name, date_time=FIXED_DATE)
+                info.external_attr = 0o644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, 'rb') as f:
+                    archive.writestr(info, f.read())
+
+    print(f"Wrote {len(files)} files to {PACKAGE_PATH}")
+
+
+if __name__ == '__main__':
+    build()
@@ -1,51 +1,18 @@
 import boto3
+import os
 import time
 import sys
 import re
 import json
 from collections import defaultdict
 from datetime import datetime, timedelta
-
-def get_kv_relationship(key_map, value_map, block_map):
-    kvs = defaultdict(list)
-    for block_id, key_block in key_map.items():
-        value_block = find_value_block(key_block, value_map)
-        if value_block:
-            key = get_text(key_block, block_map)
-            val = get_text(value_block, block_map)
-            if key and val:
-                kvs[key].append(val)
-    return kvs
-
-def find_value_block(key_block, value_map):
-    if 'Relationships' not in key_block:
-        return None
-    for relationship in key_block['Relationships']:
-        if relationship['Type'] == 'VALUE':
-            for value_id in relationship['Ids']:
-                return value_map.get(value_id)
-    return None
-
-def get_text(result, blocks_map):
-    text = ''
-    if 'Relationships' in result:
-        for relationship in result['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for child_id in relationship['Ids']:
-                    word = blocks_map.get(child_id)
-                    if not word:
-                        continue
-                    if word['BlockType'] == 'WORD':
-                        text += word.get('Text', '') + ' '
-                    elif word['BlockType'] == 'SELECTION_ELEMENT':
-                        if word.get('SelectionStatus') == 'SELECTED':
-                            text += 'X '
-    return text.strip()
-
-# def print_kvs(kvs):
-#     for key, value in kvs.items():
-#         print(f"{key} : {value}")
-
+from scheduler import (
+    AdmissionScheduler,
+    DynamoDBInFlightCounter,
+    LocalInFlightCounter,
+)
+from parser import parse_textract_blocks
+from text_layer import build_pages_pdf, extract_text_layer, is_local_extraction_available
 
 def move_skipped_files_to_s3(source_bucket, s3_folder_name, destination_bucket, skipped_files, s3_client, destination_folder='skipped'):
     deleted_folders = set()  # Track processed folders
@@ -87,6 +54,207 @@ def move_skipped_files_to_s3(source_bucket, s3_folder_name, destination_bucket,
 
 
 
+def get_extracted_keys(s3_client, text_bucket, prefix):
+    # Documents whose .txt/.json were written by an earlier attempt of this folder
+    existing = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=text_bucket, Prefix=prefix):
+        existing.update(obj['Key'] for obj in page.get('Contents', []))
+    return {key[:-len('.txt')] for key in existing
+            if key.endswith('.txt') and key[:-len('.txt')] + '.json' in existing}
+
+
+def build_admission_scheduler(waiter_id):
+    quota = int(os.environ.get('TEXTRACT_MAX_CONCURRENT_JOBS', '100'))
+    max_wait = int(os.environ.get('TEXTRACT_ADMISSION_MAX_WAIT', '120'))
+    lease_seconds = int(os.environ.get('TEXTRACT_LEASE_SECONDS', '900'))
+    table_name = os.environ.get('TEXTRACT_INFLIGHT_TABLE')
+
+    # Shared DynamoDB leases when deployed, in-process stand-in otherwise
+    if table_name:
+        counter = DynamoDBInFlightCounter(boto3.resource('dynamodb').Table(table_name))
+    else:
+        counter = LocalInFlightCounter()
+
+    return AdmissionScheduler(counter, quota, max_wait=max_wait, lease_seconds=lease_seconds,
+                              waiter_id=waiter_id)
+
+
+def merge_textract_pages(local, page_lines, kvs):
+    # Textract page numbers are relative to the sub-document of scanned pages
+    ocr_pages = {
+        page_number: page_lines.get(index, [])
+        for index, page_number in enumerate(local['image_only_pages'], start=1)
+    }
+
+    lines = []
+    for page_number, local_lines in enumerate(local['pages'], start=1):
+        lines.extend(ocr_pages[page_number] if local_lines is None else local_lines)
+
+    merged = defaultdict(list)
+    for source in (local['kvs'], kvs):
+        for label, values in source.items():
+            merged[label].extend(values)
+    return lines, merged
+
+
+def write_extraction_output(s3_client, text_bucket, key, lines, kvs):
+    text = ''.join(line + ' ' for line in lines)
+
+    # Upload the extracted text to S3
+    key_name = key + ".txt"
+    s3_client.put_object(Bucket=text_bucket, Key=key_name, Body=text)
+    print(f"Uploaded extracted text to {key_name}")
+
+    body = json.dumps(kvs, indent=4)
+    folder_name = key + ".json"
+    s3_client.put_object(Bucket=text_bucket, Key=folder_name, Body=body)
+    print(f"Uploaded key-value pairs to {folder_name}")
+
+
+def extract_local_text_layers(pending, source_bucket, text_bucket, s3_client):
+    if not is_local_extraction_available():
+        return pending
+
+    min_confidence = float(os.environ.get('LOCAL_EXTRACTION_MIN_CONFIDENCE', '0.9'))
+    # pypdf holds the parsed document and, for mixed documents, a second copy of the
+    # scanned pages in memory - keep well inside the function's 512 MB
+    max_bytes = int(os.environ.get('LOCAL_EXTRACTION_MAX_BYTES', str(10 * 1024 * 1024)))
+
+    # Born-digital PDFs are written straight from their text layer; only
+    # scanned pages and low-confidence documents are left for Textract
+    remaining = []
+    for item in pending:
+        key = item['key']
+        if item['size'] > max_bytes:
+            remaining.append(item)
+            continue
+
+        try:
+            pdf_bytes = s3_client.get_object(Bucket=source_bucket, Key=key)['Body'].read()
+            start = time.monotonic()
+            extraction = extract_text_layer(pdf_bytes)
+            elapsed = time.monotonic() - start
+
+            if not extraction['lines'] or extraction['confidence'] < min_confidence:
+                print(f"Sending {key} to Textract (local confidence {extraction['confidence']:.2f})")
+                remaining.append(item)
+
+            elif not extraction['kvs'] and not extraction['image_only_pages']:
+                # Fields printed without "LABEL: value" (e.g. a label column beside
+                # the values) only come back as pairs from Textract FORMS
+                print(f"Sending {key} to Textract (no form pairs in its text layer)")
+                remaining.append(item)
+
+            elif extraction['image_only_pages']:
+                # OCR only the scanned pages, outside the folder prefix so classification never sees it
+                textract_key = f"textract-pages/{key}"
+                pages_pdf = build_pages_pdf(pdf_bytes, extraction['image_only_pages'])
+                s3_client.put_object(Bucket=text_bucket, Key=textract_key, Body=pages_pdf)
+                print(f"Sending pages {extraction['image_only_pages']} of {key} to Textract")
+                remaining.append(dict(item, size=len(pages_pdf), document_bucket=text_bucket,
+                                      document_key=textract_key, local=extraction))
+
+            else:
+                write_extraction_output(s3_client, text_bucket, key, extraction['lines'], extraction['kvs'])
+                print(f"Extracted {key} from its text layer in {elapsed:.2f}s")
+
+        except Exception as e:
+            print(f"Local extraction failed for {key}: {str(e)}")
+            remaining.append(item)
+
+    return remaining
+
+
+def start_textract_job(item, source_bucket, textract_client):
+    # Start Textract analysis on the PDF file
+    response = textract_client.start_document_analysis(
+        DocumentLocation={
+            'S3Object': {
+                'Bucket': item.get('document_bucket', source_bucket), 
+                'Name': item.get('document_key', item['key'])
+            }
+        },
+        FeatureTypes=["FORMS"],
+    )
+
+    # Get the JobId for the Textract analysis
+    job_id = response['JobId']
+    print(f"Started Textract job with JobId: {job_id} for file: {item['key']}")
+    return job_id
+
+
+def finish_textract_job(item, job_id, text_bucket, s3_client, textract_client, deadline=None):
+    key = item['key']
+
+    # Wait for Textract analysis to complete
+    status = wait_for_textract_completion(textract_client, job_id, deadline=deadline)
+
+    if status == 'SUCCEEDED':
+        # Retrieve all blocks from Textract
+        blocks = get_all_document_analysis(textract_client, job_id)
+        page_lines, kvs = parse_textract_blocks(blocks)
+
+        if 'local' in item:
+            lines, kvs = merge_textract_pages(item['local'], page_lines, kvs)
+        else:
+            lines = [line for page in sorted(page_lines) for line in page_lines[page]]
+        write_extraction_output(s3_client, text_bucket, key, lines, kvs)
+    else:
+        print(f"Textract job {job_id} failed for file: {key}")
+
+
+def process_pending_documents(pending, source_bucket, text_bucket, s3_client, textract_client, scheduler, context=None):
+    def time_left():
+        return context.get_remaining_time_in_millis() / 1000 if context else None
+
+    try:
+        process_scheduled_batches(scheduler.schedule(pending), source_bucket, text_bucket, s3_client,
+                                  textract_client, scheduler, time_left)
+    finally:
+        # Remove scanned-page sub-documents, including those never started because
+        # admission stopped early (the bucket lifecycle rule catches hard timeouts)
+        for item in pending:
+            if 'document_key' in item:
+                s3_client.delete_object(Bucket=item['document_bucket'], Key=item['document_key'])
+
+
+def process_scheduled_batches(batches, source_bucket, text_bucket, s3_client, textract_client, scheduler, time_left):
+    for batch in batches:
+        remaining = list(batch)
+        while remaining:
+            # Start as many of the batch's jobs as there are free slots, then wait
+            # on them (and give the slots back) before asking for more
+            lease_ids = scheduler.admit(remaining, time_left())
+            admitted, remaining = remaining[:len(lease_ids)], remaining[len(lease_ids):]
+
+            started = []
+            for item, lease_id in zip(admitted, lease_ids):
+                try:
+                    job_id = start_textract_job(item, source_bucket, textract_client)
+                except Exception as e:
+                    scheduler.release(lease_id)
+                    print(f"Error processing file {item['key']}: {str(e)}")
+                    continue  # Proceed to the next file
+                started.append((item, lease_id, job_id))
+
+            # One deadline for the whole round, so it fits in the time admit() checked for
+            deadline = scheduler.round_deadline(time_left())
+            for item, lease_id, job_id in started:
+                job_finished = True
+                try:
+                    finish_textract_job(item, job_id, text_bucket, s3_client, textract_client, deadline)
+                except TimeoutError as e:
+                    # The job is still running - keep its slot until the lease expires
+                    job_finished = False
+                    print(f"Error processing file {item['key']}: {str(e)}")
+                except Exception as e:
+                    print(f"Error processing file {item['key']}: {str(e)}")
+                finally:
+                    if job_finished:
+                        scheduler.release(lease_id)
+
+
 def lambda_handler(event, context):
     source_bucket = event['BatchInput']['source_bucket']
     destination_bucket = event['BatchInput']['human_review_bucket']
@@ -96,6 +264,7 @@ def lambda_handler(event, context):
     s3_folder_name = event['Items'][0]['Prefix']
 
     skipped_files = []
+    pending = []
     pdf_found = False
     
     # List objects in the specified folder
@@ -104,6 +273,8 @@ def lambda_handler(event, context):
         Prefix=s3_folder_name
     )  
     if 'Contents' in response:
+        extracted_keys = get_extracted_keys(s3_client, text_bucket, s3_folder_name)
+
         for obj in response['Contents']:
             # Get the last modified timestamp of the object
             last_modified = obj['LastModified']
@@ -124,72 +295,21 @@ def lambda_handler(event, context):
             # Check if the object is a PDF file
             if key.lower().endswith('.pdf'):
                 pdf_found = True
-                try:
-                    # Start Textract analysis on the PDF file
-                    response = textract_client.start_document_analysis(
-                        DocumentLocation={
-                            'S3Object': {
-                                'Bucket': source_bucket, 
-                                'Name': key
-                            }
-                        },
-                        FeatureTypes=["FORMS"],
-                    )
-                    
-                    # Get the JobId for the Textract analysis
-                    job_id = response['JobId']
-                    print(f"Started Textract job with JobId: {job_id} for file: {key}")
-                    
-                    # Wait for Textract analysis to complete
-                    status = wait_for_textract_completion(textract_client, job_id)
-                    
-                    if status == 'SUCCEEDED':
-                        # Retrieve all blocks from Textract
-                        blocks = get_all_document_analysis(textract_client, job_id)
-                        
-                        # Extract text lines
-                        text = ''
-                        for block in blocks:
-                            if block['BlockType'] == "LINE":
-                                # print(block['Text'])
-                                text += block['Text'] + ' '
-                        
-                        # Upload the extracted text to S3
-                        key_name = key + ".txt"
-                        s3_client.put_object(Bucket=text_bucket, Key=key_name, Body=text)
-                        print(f"Uploaded extracted text to {key_name}")
-                        
-                        # Build key-value maps
-                        key_map = {}
-                        value_map = {}
-                        block_map = {}
-                        for block in blocks:
-                            block_id = block['Id']
-                            block_map[block_id] = block
-                            if block['BlockType'] == "KEY_VALUE_SET":
-                                if 'KEY' in block.get('EntityTypes', []):
-                                    key_map[block_id] = block
-                                elif 'VALUE' in block.get('EntityTypes', []):
-                                    value_map[block_id] = block
-                        
-                        # Get Key-Value relationships
-                        kvs = get_kv_relationship(key_map, value_map, block_map)
-                        body = json.dumps(kvs, indent=4)
-                        folder_name = key + ".json"
-                        s3_client.put_object(Bucket=text_bucket, Key=folder_name, Body=body)
-                        print(f"Uploaded key-value pairs to {folder_name}")
-                    else:
-                        print(f"Textract job {job_id} failed for file: {key}")
-                
-                except Exception as e:
-                    print(f"Error processing file {key}: {str(e)}")
-                    continue  # Proceed to the next file
+                if key in extracted_keys:
+                    # Retried folder - don't spend Textract capacity on it again
+                    print(f"Skipping {key} as its text was already extracted")
+                    continue
+                # Queue for admission - scheduled by age and size below
+                pending.append({'key': key, 'size': obj.get('Size', 0), 'age': age})
             
             else:
                 # If not a PDF, skip the file and add to skipped list
                 print(f"Skipping {key} as it is not a PDF file")
                 skipped_files.append(key)
                 s3_client.delete_object(Bucket=text_bucket,Key=s3_folder_name)
+
+        pending = extract_local_text_layers(pending, source_bucket, text_bucket, s3_client)
+        process_pending_documents(pending, source_bucket, text_bucket, s3_client, textract_client, build_admission_scheduler(s3_folder_name), context)
             
         # If no PDF files were found, return an error
         if not pdf_found:
@@ -216,7 +336,7 @@ def lambda_handler(event, context):
             'message': 'All files successfuly processed!'
         }
 
-def wait_for_textract_completion(textract_client, job_id, max_retries=30, delay=10):
+def wait_for_textract_completion(textract_client, job_id, max_retries=30, delay=10, deadline=None):
 
     retries = 0
     while retries < max_retries:
@@ -231,7 +351,14 @@ def wait_for_textract_completion(textract_client, job_id, max_retries=30, delay=
             print(f"Error fetching job status for {job_id}: {str(e)}")
         
         retries += 1
-        time.sleep(delay)
+        if deadline is not None:
+            # Checked at least once, then only until the round's shared deadline
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+        else:
+            time.sleep(delay)
     
     raise TimeoutError(f"Textract job {job_id} did not complete within the expected time.")
 
@@ -1,24 +1,25 @@
-import sys
-import re
-import json
 from collections import defaultdict
 
 def get_kv_relationship(key_map, value_map, block_map):
     kvs = defaultdict(list)
     for block_id, key_block in key_map.items():
         value_block = find_value_block(key_block, value_map)
-        key = get_text(key_block, block_map)
-        val = get_text(value_block, block_map)
-        kvs[key].append(val)
+        if value_block:
+            key = get_text(key_block, block_map)
+            val = get_text(value_block, block_map)
+            if key and val:
+                kvs[key].append(val)
     return kvs
 
 
 def find_value_block(key_block, value_map):
+    if 'Relationships' not in key_block:
+        return None
     for relationship in key_block['Relationships']:
         if relationship['Type'] == 'VALUE':
             for value_id in relationship['Ids']:
-                value_block = value_map[value_id]
-    return value_block
+                return value_map.get(value_id)
+    return None
 
 
 def get_text(result, blocks_map):
@@ -27,14 +28,40 @@ def get_text(result, blocks_map):
         for relationship in result['Relationships']:
             if relationship['Type'] == 'CHILD':
                 for child_id in relationship['Ids']:
-                    word = blocks_map[child_id]
+                    word = blocks_map.get(child_id)
+                    if not word:
+                        continue
                     if word['BlockType'] == 'WORD':
-                        text += word['Text'] + ' '
-                    if word['BlockType'] == 'SELECTION_ELEMENT':
-                        if word['SelectionStatus'] == 'SELECTED':
+                        text += word.get('Text', '') + ' '
+                    elif word['BlockType'] == 'SELECTION_ELEMENT':
+                        if word.get('SelectionStatus') == 'SELECTED':
                             text += 'X '
+    return text.strip()
 
-    return text
+
+def parse_textract_blocks(blocks):
+    # Extract text lines, grouped by page
+    page_lines = defaultdict(list)
+    for block in blocks:
+        if block['BlockType'] == "LINE":
+            page_lines[block.get('Page', 1)].append(block['Text'])
+
+    # Build key-value maps
+    key_map = {}
+    value_map = {}
+    block_map = {}
+    for block in blocks:
+        block_id = block['Id']
+        block_map[block_id] = block
+        if block['BlockType'] == "KEY_VALUE_SET":
+            if 'KEY' in block.get('EntityTypes', []):
+                key_map[block_id] = block
+            elif 'VALUE' in block.get('EntityTypes', []):
+                value_map[block_id] = block
+
+    # Get Key-Value relationships
+    kvs = get_kv_relationship(key_map, value_map, block_map)
+    return page_lines, kvs
 
 
 def print_kvs(kvs):
@@ -0,0 +1,323 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+class AdmissionTimeoutError(Exception):
+    """Raised when a Textract slot could not be acquired within the allowed wait."""
+    pass
+
+
+def slots_for(count, quota, leases, waiters, waiter):
+    """
+    Number of slots a caller may take now.
+
+    Free slots go to the pending documents of older waiters first; waiters
+    are ordered by their oldest pending document (then by id, for ties).
+    """
+    free = quota - len(leases)
+    if waiter:
+        position = (waiter['oldest'], waiter['id'])
+        free -= sum(int(entry['pending']) for waiter_id, entry in waiters.items()
+                    if waiter_id != waiter['id'] and (int(entry['oldest']), waiter_id) < position)
+    return max(min(count, free), 0)
+
+
+def update_waiters(waiters, waiter, granted, now, waiter_seconds):
+    # An admitted waiter leaves the queue; one still waiting (or about to retry) keeps its place
+    waiters = dict(waiters)
+    if not waiter:
+        return waiters
+    if granted:
+        waiters.pop(waiter['id'], None)
+    else:
+        waiters[waiter['id']] = {'oldest': waiter['oldest'], 'pending': waiter['pending'],
+                                 'expiresAt': now + waiter_seconds}
+    return waiters
+
+
+def queue_state(leases, waiters, now):
+    # Global admission state as stored with the leases, for metrics
+    oldest = min((int(entry['oldest']) for entry in waiters.values()), default=None)
+    return {
+        'in_flight': len(leases),
+        'waiters': len(waiters),
+        'pending': sum(int(entry['pending']) for entry in waiters.values()),
+        'oldest_age': now - oldest if oldest is not None else None
+    }
+
+
+class LocalInFlightCounter:
+    # In-process stand-in for the shared lease table (local runs / no table configured)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._waiters = {}
+        self.last_state = None
+
+    def _prune(self, now):
+        self._leases = {lease_id: expires_at for lease_id, expires_at in self._leases.items()
+                        if expires_at > now}
+        self._waiters = {waiter_id: entry for waiter_id, entry in self._waiters.items()
+                         if entry['expiresAt'] > now}
+
+    def try_acquire(self, count, quota, lease_seconds, waiter=None, waiter_seconds=90):
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            granted = slots_for(count, quota, self._leases, self._waiters, waiter)
+            self._waiters = update_waiters(self._waiters, waiter, granted, now, waiter_seconds)
+            lease_ids = [uuid.uuid4().hex for _ in range(granted)]
+            for lease_id in lease_ids:
+                self._leases[lease_id] = now + lease_seconds
+            self.last_state = queue_state(self._leases, self._waiters, now)
+            return lease_ids
+
+    def release(self, lease_id):
+        with self._lock:
+            self._leases.pop(lease_id, None)
+
+
+class DynamoDBInFlightCounter:
+    """
+    In-flight Textract jobs shared by every concurrent extract-text invocation.
+
+    Each admitted job holds a lease (id -> expiresAt) in a map on a single item,
+    and only unexpired leases count against the quota, so slots held by an
+    invocation that was killed before releasing them come back on their own.
+    Invocations that are waiting for slots register in a second map with the
+    age of their oldest pending document, so free slots go to the oldest work
+    across all folders. Writes are guarded by a version attribute so concurrent
+    acquires can't overshoot the quota.
+    """
+
+    def __init__(self, table, counter_id='textract-analysis', max_conflicts=10):
+        self.table = table
+        self.counter_id = counter_id
+        self.max_conflicts = max_conflicts
+        # State of the item as last read or written by try_acquire
+        self.last_state = None
+
+    def _read(self):
+        response = self.table.get_item(Key={'counterId': self.counter_id}, ConsistentRead=True)
+        return response.get('Item', {})
+
+    def try_acquire(self, count, quota, lease_seconds, waiter=None, waiter_seconds=90):
+        for _ in range(self.max_conflicts):
+            item = self._read()
+            now = int(time.time())
+            leases = {lease_id: int(expires_at) for lease_id, expires_at in item.get('leases', {}).items()
+                      if int(expires_at) > now}
+            waiters = {waiter_id: entry for waiter_id, entry in item.get('waiters', {}).items()
+                       if int(entry['expiresAt']) > now}
+            granted = slots_for(count, quota, leases, waiters, waiter)
+
+            if not granted:
+                # Only write when our place in the queue is new, changed or about to lapse
+                entry = waiters.get(waiter['id']) if waiter else None
+                if not waiter or (entry and int(entry['oldest']) == waiter['oldest']
+                                  and int(entry['pending']) == waiter['pending']
+                                  and int(entry['expiresAt']) - now > waiter_seconds / 2):
+                    self.last_state = queue_state(leases, waiters, now)
+                    return []
+
+            lease_ids = [uuid.uuid4().hex for _ in range(granted)]
+            for lease_id in lease_ids:
+                leases[lease_id] = now + lease_seconds
+            waiters = update_waiters(waiters, waiter, granted, now, waiter_seconds)
+
+            version = int(item.get('version', 0))
+            try:
+                self.table.update_item(
+                    Key={'counterId': self.counter_id},
+                    UpdateExpression='SET leases = :leases, waiters = :waiters, version = :next',
+                    ConditionExpression='attribute_not_exists(version) OR version = :version',
+                    ExpressionAttributeValues={':leases': leases, ':waiters': waiters,
+                                               ':next': version + 1, ':version': version}
+                )
+                self.last_state = queue_state(leases, waiters, now)
+                return lease_ids
+            except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+                # Another invocation changed the leases - re-read and try again
+                continue
+        return []
+
+    def release(self, lease_id):
+        self.table.update_item(
+            Key={'counterId': self.counter_id},
+            UpdateExpression='REMOVE leases.#lease ADD version :one',
+            ExpressionAttributeNames={'#lease': lease_id},
+            ExpressionAttributeValues={':one': 1}
+        )
+
+
+def order_by_age(work_items):
+    # Oldest first so documents closest to breaching the SLA are admitted first
+    return sorted(work_items, key=lambda item: item['age'].total_seconds(), reverse=True)
+
+
+def pack_by_size(work_items, max_batch_bytes, max_batch_items):
+    """
+    Split age-ordered work items into consecutive size-bounded batches.
+
+    Items are taken in order and a batch is closed as soon as the next item
+    would take it over max_batch_bytes or max_batch_items, so batches (and the
+    items within them) keep the oldest-first order. An item larger than
+    max_batch_bytes gets a batch of its own.
+    """
+    batches = []
+    for item in work_items:
+        batch = batches[-1] if batches else None
+        if (batch and len(batch['items']) < max_batch_items
+                and batch['bytes'] + item['size'] <= max_batch_bytes):
+            batch['items'].append(item)
+            batch['bytes'] += item['size']
+        else:
+            batches.append({'items': [item], 'bytes': item['size']})
+    return [batch['items'] for batch in batches]
+
+
+def emit_metrics(metrics, units):
+    # CloudWatch Embedded Metric Format - picked up from the Lambda log stream
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    record = {
+        '_aws': {
+            'Timestamp': int(datetime.now(timezone.utc).timestamp() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': 'DocuStream/TextractAdmission',
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in metrics]
+            }]
+        },
+        'FunctionName': function_name
+    }
+    record.update(metrics)
+    print(json.dumps(record))
+
+
+class AdmissionScheduler:
+    """
+    Admits Textract jobs only while the shared in-flight counter is under quota.
+
+    Pending work is ordered oldest first and packed into size-bounded batches.
+    Each batch is started in rounds of as many jobs as there are free slots,
+    and a round is awaited before the next is admitted. While waiting, the
+    invocation is registered with the counter under waiter_id (the folder, so
+    a retried invocation keeps its place) and the age of its oldest pending
+    document; slots go to the oldest waiters first.
+
+    Each admission decision emits one metrics record: the global queue (waiting
+    invocations, their pending documents and oldest pending age) and in-flight
+    jobs as stored with the leases, how long this decision waited, and for
+    admitted documents how long each waited since it was uploaded.
+    """
+
+    def __init__(self, counter, quota, max_wait=120, poll_interval=2, lease_seconds=900,
+                 round_seconds=330, finish_seconds=30, max_batch_bytes=50 * 1024 * 1024,
+                 max_batch_items=5, waiter_id=None, waiter_seconds=90):
+        self.counter = counter
+        self.quota = quota
+        # A waiter's place outlives its invocation by waiter_seconds, which must
+        # cover the Step Functions retry interval after an AdmissionTimeoutError
+        self.waiter_id = waiter_id
+        self.waiter_seconds = waiter_seconds
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        # A lease must outlive the Textract job; round_seconds is the time budget
+        # shared by all jobs of one round, the last finish_seconds of which are
+        # kept for fetching and writing results
+        self.lease_seconds = lease_seconds
+        self.round_seconds = round_seconds
+        self.finish_seconds = finish_seconds
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_items = max_batch_items
+        self.pending = []
+        self.scheduled_at = time.time()
+
+    def schedule(self, work_items):
+        ordered = order_by_age(work_items)
+        # Documents not yet admitted, oldest first
+        self.pending = list(ordered)
+        self.scheduled_at = time.time()
+        return pack_by_size(ordered, self.max_batch_bytes, self.max_batch_items)
+
+    def admit(self, items, time_left=None):
+        """
+        Acquire leases for up to len(items) jobs and return the granted lease ids.
+
+        Waits only until at least one slot is free, so callers must finish the
+        jobs they were granted before admitting the rest - an invocation never
+        blocks while holding slots. time_left (seconds remaining in the Lambda)
+        caps the wait so a round is only admitted if it can still be awaited.
+        """
+        max_wait = self.max_wait
+        if time_left is not None:
+            max_wait = min(max_wait, time_left - self.round_seconds)
+
+        waiter = None
+        if self.waiter_id and self.pending:
+            waiter = {'id': self.waiter_id, 'pending': len(self.pending),
+                      'oldest': int(self.scheduled_at - self.pending[0]['age'].total_seconds())}
+
+        start = time.monotonic()
+        while True:
+            if max_wait < 0:
+                lease_ids = []
+            else:
+                lease_ids = self.counter.try_acquire(len(items), self.quota, self.lease_seconds,
+                                                     waiter, self.waiter_seconds)
+            if lease_ids:
+                break
+            waited = time.monotonic() - start
+            if waited >= max_wait:
+                self.emit_decision(waited, {'AdmissionTimeouts': 1}, {'AdmissionTimeouts': 'Count'})
+                if max_wait < 0:
+                    raise AdmissionTimeoutError(
+                        f"Not enough time left to await another Textract round - "
+                        f"{len(items)} documents deferred"
+                    )
+                raise AdmissionTimeoutError(
+                    f"No Textract slot available for {items[0]['key']} after {waited:.0f}s "
+                    f"(quota {self.quota}, {len(items)} documents deferred)"
+                )
+            time.sleep(self.poll_interval)
+
+        waited = time.monotonic() - start
+        admitted = items[:len(lease_ids)]
+        self.pending = [item for item in self.pending if not any(item is other for other in admitted)]
+        # Time since upload, per admitted document (an EMF array of values)
+        elapsed = time.time() - self.scheduled_at
+        self.emit_decision(
+            waited,
+            {'DocumentWaitSeconds': [item['age'].total_seconds() + elapsed for item in admitted]},
+            {'DocumentWaitSeconds': 'Seconds'}
+        )
+        print(f"Admitted {len(lease_ids)} of {len(items)} documents after waiting {waited:.1f}s")
+        return lease_ids
+
+    def emit_decision(self, waited, metrics, units):
+        metrics = dict(metrics, AdmissionWaitSeconds=waited)
+        units = dict(units, AdmissionWaitSeconds='Seconds')
+        state = self.counter.last_state
+        if state:
+            metrics.update(GlobalQueueDepth=state['pending'], WaitingInvocations=state['waiters'],
+                           InFlightJobs=state['in_flight'])
+            units.update(GlobalQueueDepth='Count', WaitingInvocations='Count', InFlightJobs='Count')
+            if state['oldest_age'] is not None:
+                metrics['OldestWaitingAgeSeconds'] = state['oldest_age']
+                units['OldestWaitingAgeSeconds'] = 'Seconds'
+        emit_metrics(metrics, units)
+
+    def round_deadline(self, time_left=None):
+        """Monotonic deadline for awaiting every job started in the current round."""
+        budget = self.round_seconds
+        if time_left is not None:
+            budget = min(budget, time_left)
+        return time.monotonic() + budget - self.finish_seconds
+
+    def release(self, lease_id):
+        self.counter.release(lease_id)
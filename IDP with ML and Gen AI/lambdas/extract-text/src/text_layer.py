@@ -0,0 +1,241 @@
+import io
+import re
+import unicodedata
+from collections import defaultdict
+
+# pypdf must be bundled in the deployment package for the local fast path;
+# without it every document goes to Textract as before.
+try:
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import ContentStream
+except ImportError:
+    PdfReader = None
+    PdfWriter = None
+
+# Pages with fewer extractable characters than this are treated as having no text layer
+MIN_CHARS_PER_PAGE = 20
+
+# A page whose painted images cover at least this share of it is a scan; its text
+# layer is only trusted when it is substantial (an OCR'd "searchable" scan), not a
+# fax header or scanner stamp laid over the image
+SCANNED_PAGE_COVERAGE = 0.5
+MIN_CHARS_PER_SCANNED_PAGE = 500
+
+# "LABEL: value" as printed on forms (e.g. "CLAIM #: 1234", "Date of Accident: 01/02/2024").
+# Labels are matched in any case - extract-key-values upper-cases keys before mapping them.
+FORM_PAIR_PATTERN = re.compile(r"^([A-Za-z][A-Za-z0-9 #&/().'-]{0,48}[A-Za-z0-9#)])\s*:\s+(.*\S)$")
+
+# A value that still contains "label: " probably swallowed the next field on the line
+EMBEDDED_LABEL_PATTERN = re.compile(r"[A-Za-z#)]\s*:\s")
+
+# Token shapes seen in genuine form text; fonts without a ToUnicode map decode
+# to printable but wrong characters that rarely fit these
+TOKEN_PUNCTUATION = '.,;:!?()[]{}"\'*'
+NUMBER_PATTERN = re.compile(r"^[$#]?\d+([.,/:-]\d+)*%?$")
+ORDINAL_PATTERN = re.compile(r"^\d+(:\d+)?(st|nd|rd|th|am|pm)$", re.IGNORECASE)
+CODE_PATTERN = re.compile(r"^[A-Z0-9]+([-/][A-Z0-9]+)*$")
+EMAIL_PATTERN = re.compile(r"^[\w.+-]+@[\w-]+(\.[\w-]+)+$")
+WORD_PATTERN = re.compile(r"^[A-Za-z]+([-'&/][A-Za-z]+)*$")
+VOWELS = set('aeiouyAEIOUY')
+
+# Layout-mode extraction keeps the horizontal gap between separately positioned fields
+COLUMN_GAP_PATTERN = re.compile(r"\s{2,}|\t")
+
+
+def is_local_extraction_available():
+    return PdfReader is not None
+
+
+def printable_ratio(text):
+    # Broken font encodings surface as replacement / private-use / control characters
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    good = 0
+    for c in chars:
+        category = unicodedata.category(c)
+        if c != '\ufffd' and category not in ('Co', 'Cc', 'Cn', 'Cs'):
+            good += 1
+    return good / len(chars)
+
+
+def is_plausible_token(token):
+    """Return whether a token is word-shaped, or None if it should not be counted."""
+    core = token.strip(TOKEN_PUNCTUATION)
+    if not any(c.isalnum() for c in core):
+        # Rules, checkboxes and bullets are ignored; runs of mixed symbols are not
+        return False if len(set(token)) > 2 and len(token) > 2 else None
+
+    if any(c.isdigit() for c in core):
+        return bool(NUMBER_PATTERN.match(core) or ORDINAL_PATTERN.match(core)
+                    or CODE_PATTERN.match(core))
+    if EMAIL_PATTERN.match(core):
+        return True
+    if not WORD_PATTERN.match(core):
+        return False
+
+    letters = [c for c in core if c.isalpha()]
+    # At most one lower-to-upper switch ("McDonald"), and longer words need a vowel
+    case_switches = sum(1 for a, b in zip(letters, letters[1:]) if a.islower() and b.isupper())
+    return case_switches <= 1 and (len(letters) <= 3 or any(c in VOWELS for c in letters))
+
+
+def word_shape_counts(text):
+    plausible = 0
+    counted = 0
+    for token in text.split():
+        result = is_plausible_token(token)
+        if result is not None:
+            counted += 1
+            plausible += result
+    return plausible, counted
+
+
+def multiply(m, n):
+    # Product of two PDF transformation matrices [a b c d e f]
+    return [
+        m[0] * n[0] + m[1] * n[2], m[0] * n[1] + m[1] * n[3],
+        m[2] * n[0] + m[3] * n[2], m[2] * n[1] + m[3] * n[3],
+        m[4] * n[0] + m[5] * n[2] + n[4], m[4] * n[1] + m[5] * n[3] + n[5],
+    ]
+
+
+def painted_image_area(content, resources, pdf, ctm, depth=0):
+    # Area (in user space) covered by images drawn with Do, following Form XObjects
+    xobjects = (resources or {}).get('/XObject')
+    if content is None or not xobjects or depth > 3:
+        return 0.0
+
+    xobjects = xobjects.get_object()
+    area = 0.0
+    stack = []
+    for operands, operator in ContentStream(content, pdf).operations:
+        if operator == b'q':
+            stack.append(ctm)
+        elif operator == b'Q' and stack:
+            ctm = stack.pop()
+        elif operator == b'cm':
+            ctm = multiply([float(value) for value in operands], ctm)
+        elif operator == b'Do' and operands[0] in xobjects:
+            xobject = xobjects[operands[0]].get_object()
+            if xobject.get('/Subtype') == '/Image':
+                # The image fills the unit square mapped through the CTM
+                area += abs(ctm[0] * ctm[3] - ctm[1] * ctm[2])
+            elif xobject.get('/Subtype') == '/Form':
+                matrix = [float(value) for value in xobject.get('/Matrix', [1, 0, 0, 1, 0, 0])]
+                area += painted_image_area(xobject, xobject.get('/Resources'), pdf,
+                                           multiply(matrix, ctm), depth + 1)
+    return area
+
+
+def image_coverage(page):
+    """Share of the page covered by painted images (overlaps count twice, capped at 1)."""
+    page_area = float(page.mediabox.width) * float(page.mediabox.height)
+    if not page_area:
+        return 0.0
+    area = painted_image_area(page.get_contents(), page.get('/Resources'), page.pdf, [1, 0, 0, 1, 0, 0])
+    return min(area / page_area, 1.0)
+
+
+def get_form_pairs(lines):
+    """
+    Derive form pairs from layout-mode lines.
+
+    Returns the pairs and how many of them are ambiguous (the value looks like
+    it contains another field), which lowers the document's confidence.
+    """
+    kvs = defaultdict(list)
+    ambiguous = 0
+    for line in lines:
+        for segment in COLUMN_GAP_PATTERN.split(line):
+            match = FORM_PAIR_PATTERN.match(segment.strip())
+            if match:
+                value = match.group(2).strip()
+                if EMBEDDED_LABEL_PATTERN.search(value):
+                    ambiguous += 1
+                kvs[match.group(1).strip()].append(value)
+    return kvs, ambiguous
+
+
+def extract_text_layer(pdf_bytes):
+    """
+    Extract lines and "LABEL: value" form pairs from a PDF's embedded text layer.
+
+    Returns None when pypdf is unavailable. Otherwise returns a dict with the
+    per-page lines ('pages', None for image-only pages), the form pairs ('kvs'),
+    the 1-based 'image_only_pages' (scans, including those with only a header
+    or stamp in their text layer), and a 'confidence' score in [0, 1] for the
+    text-layer pages. A document with no usable text layer has confidence 0.
+    """
+    if PdfReader is None:
+        return None
+
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    layout_lines = []
+    pages = []
+    image_only_pages = []
+    text_chars = 0
+    printable_chars = 0.0
+    plausible_tokens = 0
+    counted_tokens = 0
+
+    for page_number, page in enumerate(reader.pages, start=1):
+        text = page.extract_text(extraction_mode="layout") or ''
+        stripped = ''.join(text.split())
+
+        coverage = image_coverage(page)
+        if coverage >= SCANNED_PAGE_COVERAGE and len(stripped) < MIN_CHARS_PER_SCANNED_PAGE:
+            # Scanned page, at most a header or stamp in its text layer - needs OCR
+            pages.append(None)
+            image_only_pages.append(page_number)
+            continue
+
+        if len(stripped) < MIN_CHARS_PER_PAGE:
+            if coverage:
+                # Little text but an image (e.g. a signature) - needs OCR
+                pages.append(None)
+                image_only_pages.append(page_number)
+            else:
+                # Blank page
+                pages.append([])
+            continue
+
+        text_chars += len(stripped)
+        printable_chars += printable_ratio(text) * len(stripped)
+        plausible, counted = word_shape_counts(text)
+        plausible_tokens += plausible
+        counted_tokens += counted
+        page_layout_lines = [line for line in text.splitlines() if line.strip()]
+        layout_lines.extend(page_layout_lines)
+        # Collapse the layout padding for the .txt output
+        pages.append([' '.join(line.split()) for line in page_layout_lines])
+
+    # Both checks must pass: no broken characters, and text that looks like words
+    confidence = printable_chars / text_chars if text_chars else 0.0
+    if counted_tokens:
+        confidence *= plausible_tokens / counted_tokens
+    lines = [line for page_lines in pages if page_lines for line in page_lines]
+
+    kvs, ambiguous = get_form_pairs(layout_lines)
+    pair_count = sum(len(values) for values in kvs.values())
+    if pair_count:
+        confidence *= 1 - ambiguous / pair_count
+
+    return {
+        'pages': pages,
+        'lines': lines,
+        'kvs': kvs,
+        'image_only_pages': image_only_pages,
+        'confidence': confidence
+    }
+
+
+def build_pages_pdf(pdf_bytes, page_numbers):
+    # Sub-document with only the given 1-based pages, for OCR of the scanned pages
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    writer = PdfWriter()
+    for page_number in page_numbers:
+        writer.add_page(reader.pages[page_number - 1])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()